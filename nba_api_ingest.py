@@ -1,11 +1,26 @@
 import requests
+import requests_cache
 import os
-import json
+import orjson
+import collections
 import datetime
+import functools
+import io
+import itertools
+import logging
+import queue
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from google.api_core.exceptions import NotFound
 from google.oauth2 import service_account
 from google.cloud import storage
 from google.cloud import bigquery
 
+logger = logging.getLogger(__name__)
+
 # --- Configuration ---
 SERVICE_ACCOUNT_KEY_PATH = ""
 PROJECT_ID = 
@@ -13,6 +28,35 @@ GCS_BUCKET_NAME =
 
 BIGQUERY_DATASET_ID = 'nba_raw_data' # BigQuery Dataset where all tables will be created
 
+# Size of each chunk in the resumable GCS upload (must be a multiple of 256 KiB)
+GCS_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Large uploads are split into GCS shards of about this size, which BigQuery loads in parallel
+GCS_SHARD_MAX_BYTES = 256 * 1024 * 1024
+
+# Maximum number of fetched API pages buffered ahead of the GCS upload
+PAGE_QUEUE_MAXSIZE = 4
+
+# Number of API pages fetched concurrently per endpoint once the page count is known
+PAGE_FETCH_WORKERS = 8
+
+# Endpoints with fewer records than this are loaded into BigQuery directly instead of via GCS
+DIRECT_LOAD_MAX_ROWS = 50000
+
+# Maximum number of distinct record key layouts remembered by standardize_keys_to_lowercase
+LOWERCASE_SCHEMA_CACHE_MAX_SIZE = 10000
+
+# GCS prefix where BigQuery table schemas are cached after the first autodetected load
+BIGQUERY_SCHEMA_CACHE_PREFIX = 'schemas/'
+
+# Stage large endpoints in GCS before loading them (keeps a raw NDJSON copy in the bucket).
+# When False, every endpoint is loaded into BigQuery directly and no data files are written to GCS
+# (the bucket is still used for the cached table schemas under BIGQUERY_SCHEMA_CACHE_PREFIX).
+ARCHIVE_TO_GCS = True
+
+# In-memory size of the NDJSON spool used for direct loads of large endpoints before it spills to a temp file
+DIRECT_LOAD_SPOOL_MAX_BYTES = 64 * 1024 * 1024
+
 # The base URL for the NBA API from your provided swagger documentation
 NBA_API_BASE_URL = 'https://api.server.nbaapi.com'
 
@@ -33,6 +77,38 @@ BIGQUERY_TABLE_ID_PLAYERADVANCEDSTATS = 'api_playeradvancedstats_raw'
 NBA_API_ENDPOINT_PLAYERSHOTCHART = '/api/playershotchart'
 BIGQUERY_TABLE_ID_PLAYERSHOTCHART = 'api_playershotchart_raw'
 
+# (connect, read) timeouts in seconds for NBA API calls
+NBA_API_TIMEOUT = (5, 30)
+
+# Number of endpoints ingested at the same time
+NBA_API_MAX_CONCURRENT_ENDPOINTS = 4
+
+# On-disk cache of NBA API responses so re-runs within NBA_API_CACHE_EXPIRE_SECONDS don't re-download
+# unchanged pages. Expired responses carrying ETag/Last-Modified are revalidated with a conditional request.
+NBA_API_CACHE_NAME = 'nba_api_cache'
+NBA_API_CACHE_EXPIRE_SECONDS = 3600
+
+# Shared HTTP session so every page reuses pooled keep-alive connections instead of a new TLS handshake.
+# Transient failures and rate limiting are retried with exponential backoff, honouring Retry-After.
+_SESSION = requests_cache.CachedSession(
+    # Anchored to the script's directory so the cache file doesn't land in whatever directory it's run from
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), NBA_API_CACHE_NAME),
+    backend='sqlite',
+    expire_after=NBA_API_CACHE_EXPIRE_SECONDS,
+)
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    # Enough keep-alive connections for every endpoint's page workers to run at once without reconnecting
+    pool_maxsize=NBA_API_MAX_CONCURRENT_ENDPOINTS * PAGE_FETCH_WORKERS,
+    max_retries=Retry(total=5, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# Sentinel placed on the page queue once the API has no more pages
+_END_OF_PAGES = object()
+
+# Cache of dictionary key layout (tuple of keys) -> lowercased layout, or () if already lowercase
+_LOWERCASE_SCHEMAS = {}
+
 
 def authenticate_gcp():
     """Authenticates with Google Cloud using the service account key."""
@@ -55,96 +131,203 @@ def authenticate_gcp():
         print(f"Error loading service account credentials: {e}")
         return None
 
-def fetch_nba_data(endpoint, params=None):
+def fetch_nba_api_page(full_api_url, params, page):
     """
-    Makes calls to the NBA API endpoint with given parameters, handling pagination,
-    and returns a combined list of all JSON responses from all pages.
+    Fetches and decodes a single page of an NBA API endpoint.
+    Each page is decoded whole with orjson rather than stream-parsed: a streaming decoder
+    would have to read response.raw, bypassing the response cache and gzip/br decoding.
+    Memory stays bounded by the in-flight page window in iter_nba_data_pages instead.
+    Errors are reported and then re-raised so that callers can abort cleanly.
     """
-    all_data = []
-    page = 1
-    has_more_pages = True
+    params = dict(params, page=page) # Per-page copy so concurrent calls don't share state
+    logger.debug("Calling NBA API: %s with parameters: %s", full_api_url, params)
 
-    # Ensure params is a mutable dictionary
-    if params is None:
-        params = {}
-    else:
-        params = params.copy() # Make a copy to avoid modifying the original dict
+    try:
+        response = _SESSION.get(full_api_url, params=params, timeout=NBA_API_TIMEOUT)
+        response.raise_for_status()
+        logger.debug("API Call successful! Status Code: %s", response.status_code)
+        return orjson.loads(response.content)
+    except requests.exceptions.RequestException as e:
+        print(f"Error calling NBA API at {full_api_url}: {e}")
+        raise
+    except orjson.JSONDecodeError:
+        print("Error: API response is not valid JSON.")
+        response_content = response.text[:500] if hasattr(response, 'text') else 'No response content available.'
+        print(f"Response content: {response_content}...")
+        raise
+
+def get_page_records(json_response, page):
+    """Extracts the list of records from a decoded NBA API page."""
+    if isinstance(json_response, list):
+        return json_response
+    page_data = json_response.get('data')
+    if isinstance(page_data, list):
+        return page_data # Data from current page
+    elif page == 1:
+        print("Warning: API response does not contain a 'data' list. Yielding entire response as a single item.")
+        return [json_response]
+    return []
+
+def iter_nba_data_pages(endpoint, params=None):
+    """
+    Makes calls to the NBA API endpoint with given parameters, handling pagination,
+    and yields the list of records from each page in page order.
+    The first page reveals the total page count; the remaining pages are then
+    fetched concurrently on the shared session.
+    """
+    params = dict(params or {}) # Make a copy to avoid modifying the original dict
+    full_api_url = NBA_API_BASE_URL + endpoint
+    print(f"\nCalling NBA API: {full_api_url} with parameters: {params}")
+
+    json_response = fetch_nba_api_page(full_api_url, params, 1)
+    yield get_page_records(json_response, 1)
+
+    # Check for pagination info to determine if there are more pages
+    pagination = json_response.get('pagination') if isinstance(json_response, dict) else None
+    if not isinstance(pagination, dict):
+        return # If no pagination info, assume it's a single page response
+
+    # Corrected keys based on your API's Swagger UI output
+    current_page_from_api = pagination.get('page', 1)
+    total_pages_from_api = pagination.get('pages', current_page_from_api)
+    if current_page_from_api >= total_pages_from_api:
+        return
+    print(f"Fetching {total_pages_from_api - current_page_from_api} more page(s) from {full_api_url}")
+
+    executor = ThreadPoolExecutor(max_workers=PAGE_FETCH_WORKERS)
+    try:
+        # Only PAGE_FETCH_WORKERS pages are in flight ahead of the consumer, so decoded pages can't pile
+        # up in memory when the upload is slower than the API. Pages are yielded in order, keeping
+        # the NDJSON output deterministic.
+        pending_pages = collections.deque()
+        next_page = current_page_from_api + 1
+        while pending_pages or next_page <= total_pages_from_api:
+            while next_page <= total_pages_from_api and len(pending_pages) < PAGE_FETCH_WORKERS:
+                pending_pages.append((next_page, executor.submit(fetch_nba_api_page, full_api_url, params, next_page)))
+                next_page += 1
+            page, future = pending_pages.popleft()
+            yield get_page_records(future.result(), page)
+    finally:
+        # Don't keep fetching pages nobody will consume after an error or early stop
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def prefetch_pages(pages, maxsize=PAGE_QUEUE_MAXSIZE):
+    """
+    Runs a page generator on a background thread and yields its pages from a bounded queue,
+    so the next page is fetched while the previous one is being uploaded.
+    Exceptions raised by the generator are re-raised in the consuming thread.
+    """
+    page_queue = queue.Queue(maxsize=maxsize)
+    stop_event = threading.Event()
+
+    def put(item):
+        # Block while the queue is full, but give up once the consumer has stopped
+        while not stop_event.is_set():
+            try:
+                page_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-    while has_more_pages:
-        params['page'] = page # Add or update the page parameter
-        full_api_url = f"{NBA_API_BASE_URL}{endpoint}"
-        print(f"\nCalling NBA API: {full_api_url} with parameters: {params}")
+    def produce():
+        try:
+            for page_data in pages:
+                if not put(page_data):
+                    return
+        except Exception as e:
+            put(e)
+        else:
+            put(_END_OF_PAGES)
+        finally:
+            # Close the generator on this thread so its in-flight page fetches are cancelled right away
+            pages.close()
 
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        executor.submit(produce)
         try:
-            response = requests.get(full_api_url, params=params)
-            response.raise_for_status()
-            print(f"API Call successful! Status Code: {response.status_code}")
-            json_response = response.json()
-
-            if 'data' in json_response and isinstance(json_response['data'], list):
-                all_data.extend(json_response['data']) # Add data from current page
-            elif isinstance(json_response, list):
-
-                 all_data.extend(json_response)
-            else:
-                 if page == 1 and not all_data:
-                     all_data.append(json_response)
-                     print("Warning: API response does not contain a 'data' list. Appending entire response as a single item.")
-
-            # Check for pagination info to determine if there are more pages
-            if 'pagination' in json_response and isinstance(json_response['pagination'], dict):
-                # Corrected keys based on your API's Swagger UI output
-                current_page_from_api = json_response['pagination'].get('page', 1)
-                total_pages_from_api = json_response['pagination'].get('pages', current_page_from_api)
-
-                if current_page_from_api < total_pages_from_api:
-                    page += 1
-                else:
-                    has_more_pages = False
-            else:
-                # If no pagination info, assume it's a single page response
-                has_more_pages = False
-
-        except requests.exceptions.RequestException as e:
-            print(f"Error calling NBA API at {full_api_url}: {e}")
-            has_more_pages = False # Stop trying if there's an error
-            return None # Return None immediately if there's an error
-        except json.JSONDecodeError:
-            print("Error: API response is not valid JSON.")
-            response_content = response.text[:500] if hasattr(response, 'text') else 'No response content available.'
-            print(f"Response content: {response_content}...")
-            has_more_pages = False # Stop trying if there's a JSON decode error
-            return None # Return None immediately if there's an error
-
-    print(f"Fetched {len(all_data)} records across all pages for endpoint {endpoint}.")
-    return all_data
-
-def upload_to_gcs(credentials, data, bucket_name, filename):
-    """Uploads JSON data to a Google Cloud Storage bucket in NDJSON format."""
-    print(f"\nUploading data to GCS bucket: {bucket_name}/{filename}")
+            while True:
+                item = page_queue.get()
+                if item is _END_OF_PAGES:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop_event.set()
+
+def upload_to_gcs(storage_client, data, bucket_name, file_prefix, record_transform=None):
+    """
+    Uploads JSON data to a Google Cloud Storage bucket in NDJSON format.
+    Accepts any iterable of records (e.g. a generator fed by the API fetch); records are
+    serialized and streamed to the blob one at a time using a resumable chunked upload,
+    so the full NDJSON body is never held in memory.
+    The output is split into shards named {file_prefix}_{shard:04d}.json of roughly
+    GCS_SHARD_MAX_BYTES each, and the wildcard URI matching all shards is returned so a
+    single BigQuery load job can read them in parallel.
+    An optional record_transform is applied to each record (in place) right before it is
+    serialized, so transforms don't need a separate pass over the data.
+    """
+    print(f"\nUploading data to GCS bucket: {bucket_name}/{file_prefix}_*.json")
+    writer = None
+    finished_blobs = [] # Shards already finalized, deleted again if a later shard fails
     try:
-        storage_client = storage.Client(project=PROJECT_ID, credentials=credentials)
         bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(filename)
 
-        if isinstance(data, list):
-            ndjson_data = "\n".join(json.dumps(record) for record in data)
-        else:
-            ndjson_data = json.dumps(data)
-
-        # Upload the NDJSON string
-        blob.upload_from_string(ndjson_data, content_type='application/json')
-
-        print(f"Successfully uploaded {filename} to gs://{bucket_name}/{filename}")
-        return f"gs://{bucket_name}/{filename}"
+        if isinstance(data, dict):
+            data = [data]
+
+        # Stream one NDJSON line per record; each writer flushes every GCS_UPLOAD_CHUNK_SIZE bytes
+        record_count = 0
+        shard_count = 0
+        shard_bytes = 0
+        for record in data:
+            if writer is None or shard_bytes >= GCS_SHARD_MAX_BYTES:
+                if writer is not None:
+                    writer.close() # Finalizes the current shard
+                    writer = None
+                    finished_blobs.append(blob)
+                blob = bucket.blob(f"{file_prefix}_{shard_count:04d}.json")
+                writer = blob.open("wb", chunk_size=GCS_UPLOAD_CHUNK_SIZE, content_type='application/x-ndjson', ignore_flush=True)
+                shard_count += 1
+                shard_bytes = 0
+
+            if record_transform:
+                record_transform(record)
+            line = orjson.dumps(record)
+            writer.write(line)
+            writer.write(b"\n")
+            shard_bytes += len(line) + 1
+            record_count += 1
+
+        if writer is not None:
+            writer.close()
+            writer = None
+            finished_blobs.append(blob)
+
+        if shard_count == 0:
+            # No shard was written, so the wildcard URI would match nothing
+            print(f"No records to upload to {bucket_name}/{file_prefix}_*.json")
+            return None
+
+        gcs_uri = f"gs://{bucket_name}/{file_prefix}_*.json"
+        print(f"Successfully uploaded {record_count} records in {shard_count} shard(s) to {gcs_uri}")
+        return gcs_uri
     except Exception as e:
         print(f"Error uploading to GCS: {e}")
+        # Don't leave a partial {file_prefix}_*.json set behind in the bucket
+        try:
+            if writer is not None:
+                writer.terminate() # Cancel the partially written shard
+            for finished_blob in finished_blobs:
+                finished_blob.delete()
+        except Exception as cleanup_error:
+            print(f"Error cleaning up partial upload gs://{bucket_name}/{file_prefix}_*.json: {cleanup_error}")
         return None
 
-def create_bigquery_dataset_if_not_exists(credentials, dataset_id):
+def create_bigquery_dataset_if_not_exists(client, dataset_id):
     """Creates a BigQuery dataset if it doesn't already exist."""
     print(f"\nChecking/creating BigQuery dataset: {dataset_id}")
-    client = bigquery.Client(project=PROJECT_ID, credentials=credentials)
     dataset_ref = client.dataset(dataset_id)
     try:
         client.get_dataset(dataset_ref)
@@ -158,17 +341,59 @@ def create_bigquery_dataset_if_not_exists(credentials, dataset_id):
         else:
             print(f"Error checking/creating dataset '{dataset_id}': {e}")
 
-def load_json_to_bigquery(credentials, gcs_uri, dataset_id, table_id):
-    """Loads JSON data from GCS into a BigQuery table."""
-    print(f"\nLoading data from GCS ({gcs_uri}) to BigQuery table: {dataset_id}.{table_id}")
-    client = bigquery.Client(project=PROJECT_ID, credentials=credentials)
+def get_cached_bigquery_schema(storage_client, bq_client, bucket_name, table_id):
+    """Returns the schema cached in GCS for a BigQuery table, or None if there isn't one."""
+    blob = storage_client.bucket(bucket_name).blob(f"{BIGQUERY_SCHEMA_CACHE_PREFIX}{table_id}.json")
+    try:
+        return bq_client.schema_from_json(io.StringIO(blob.download_as_text()))
+    except NotFound:
+        return None # No schema cached yet
+    except Exception as e:
+        print(f"Error reading cached schema for table '{table_id}', falling back to autodetect: {e}")
+        return None
 
-    table_ref = client.dataset(dataset_id).table(table_id)
-    job_config = bigquery.LoadJobConfig(
+def cache_bigquery_schema(storage_client, bq_client, bucket_name, dataset_id, table_id):
+    """Saves the current schema of a BigQuery table to GCS so later loads can skip autodetect."""
+    blob = storage_client.bucket(bucket_name).blob(f"{BIGQUERY_SCHEMA_CACHE_PREFIX}{table_id}.json")
+    try:
+        table = bq_client.get_table(bq_client.dataset(dataset_id).table(table_id))
+        schema_json = io.StringIO()
+        bq_client.schema_to_json(table.schema, schema_json)
+        blob.upload_from_string(schema_json.getvalue(), content_type='application/json')
+        print(f"Cached schema for {dataset_id}.{table_id} at gs://{bucket_name}/{blob.name}")
+    except Exception as e:
+        print(f"Error caching schema for {dataset_id}.{table_id}: {e}")
+
+def clear_cached_bigquery_schema(storage_client, bucket_name, table_id):
+    """Deletes the cached schema for a BigQuery table so the next load autodetects it again."""
+    blob = storage_client.bucket(bucket_name).blob(f"{BIGQUERY_SCHEMA_CACHE_PREFIX}{table_id}.json")
+    try:
+        blob.delete()
+        print(f"Cleared cached schema for table '{table_id}'; the next run will autodetect it.")
+    except Exception as e:
+        print(f"Error clearing cached schema for table '{table_id}': {e}")
+
+def ndjson_load_job_config(schema=None):
+    """
+    Returns the BigQuery load job configuration used for all NDJSON loads.
+    When a schema is given it is used as-is; otherwise BigQuery autodetects it.
+    """
+    return bigquery.LoadJobConfig(
         source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
-        autodetect=True, # Automatically detects schema
-        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE, 
+        schema=schema,
+        autodetect=schema is None, # Automatically detects schema unless one was cached
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
     )
+
+def submit_json_load_to_bigquery(client, gcs_uri, dataset_id, table_id, schema=None):
+    """
+    Starts a BigQuery load job for JSON data in GCS without waiting for it to finish.
+    An explicit schema disables autodetection.
+    Returns the LoadJob, or None if the job could not be submitted.
+    """
+    print(f"\nLoading data from GCS ({gcs_uri}) to BigQuery table: {dataset_id}.{table_id}")
+    table_ref = client.dataset(dataset_id).table(table_id)
+    job_config = ndjson_load_job_config(schema)
     try:
         load_job = client.load_table_from_uri(
             gcs_uri,
@@ -176,114 +401,257 @@ def load_json_to_bigquery(credentials, gcs_uri, dataset_id, table_id):
             job_config=job_config
         )
         print(f"Starting BigQuery load job: {load_job.job_id}")
+        return load_job
+    except Exception as e:
+        print(f"Error loading data to BigQuery: {e}")
+        return None
+
+def records_to_ndjson_file(records, record_transform=None):
+    """
+    Serializes a small list of records into an in-memory NDJSON file.
+    An optional record_transform is applied to each record (in place) before it is serialized.
+    """
+    if record_transform:
+        for record in records:
+            record_transform(record)
+    # map() keeps the per-record serialization loop inside C instead of Python bytecode
+    return io.BytesIO(b"\n".join(map(orjson.dumps, records)))
+
+def spool_records_to_ndjson_file(records, record_transform=None):
+    """
+    Streams an iterable of records of any size into an NDJSON spool that stays in memory up to
+    DIRECT_LOAD_SPOOL_MAX_BYTES and spills to a local temp file beyond that.
+    An optional record_transform is applied to each record (in place) before it is serialized.
+    """
+    # Not a SpooledTemporaryFile: its in-memory mode is 'w+b', which load_table_from_file rejects
+    ndjson_file = io.BytesIO()
+    try:
+        for record in records:
+            if record_transform:
+                record_transform(record)
+            ndjson_file.write(orjson.dumps(record))
+            ndjson_file.write(b"\n")
+            if isinstance(ndjson_file, io.BytesIO) and ndjson_file.tell() > DIRECT_LOAD_SPOOL_MAX_BYTES:
+                spill_file = tempfile.TemporaryFile() # Opened 'rb+'
+                spill_file.write(ndjson_file.getbuffer())
+                ndjson_file.close()
+                ndjson_file = spill_file
+    except BaseException:
+        ndjson_file.close()
+        raise
+    return ndjson_file
+
+def submit_file_load_to_bigquery(client, ndjson_file, dataset_id, table_id, schema=None):
+    """
+    Starts a BigQuery load job for a local NDJSON file by uploading it with the load job itself,
+    skipping the GCS staging upload. Does not wait for the job. The file is rewound first, so
+    the same file can be submitted again. An explicit schema disables autodetection.
+    Returns the LoadJob, or None if the job could not be submitted.
+    """
+    print(f"\nLoading data directly to BigQuery table: {dataset_id}.{table_id}")
+    table_ref = client.dataset(dataset_id).table(table_id)
+    job_config = ndjson_load_job_config(schema)
+    try:
+        load_job = client.load_table_from_file(
+            ndjson_file,
+            table_ref,
+            rewind=True,
+            job_config=job_config
+        )
+        print(f"Starting BigQuery load job: {load_job.job_id}")
+        return load_job
+    except Exception as e:
+        print(f"Error loading data to BigQuery: {e}")
+        return None
+
+def wait_for_bigquery_load(load_job, dataset_id, table_id):
+    """Waits for a submitted BigQuery load job to finish. Returns True if it succeeded."""
+    try:
         load_job.result()  # Wait for the job to complete
-        print("BigQuery load job completed.")
+        print(f"BigQuery load job {load_job.job_id} completed.")
         print(f"Loaded {load_job.output_rows} rows into {dataset_id}.{table_id}.")
         return True
     except Exception as e:
         print(f"Error loading data to BigQuery: {e}")
         return False
 
+def is_schema_mismatch(load_job):
+    """
+    Returns True if a failed load job was rejected because the data didn't match its schema
+    (e.g. the API added or retyped a field), as opposed to a transient or quota error.
+    """
+    errors = load_job.errors or ([load_job.error_result] if load_job.error_result else [])
+    schema_markers = ('no such field', 'schema', 'could not convert', 'could not parse')
+    return any(
+        error.get('reason') == 'invalid'
+        and any(marker in (error.get('message') or '').lower() for marker in schema_markers)
+        for error in errors
+    )
+
 def standardize_keys_to_lowercase(data):
     """
-    Recursively converts all dictionary keys in the given data structure to lowercase.
-    Handles nested dictionaries and lists of dictionaries.
+    Converts all dictionary keys in the given data structure to lowercase, in place.
+    Handles nested dictionaries and lists of dictionaries by walking them with an
+    explicit stack, so arbitrarily deep nesting cannot hit the recursion limit.
+    Returns the same (mutated) data structure.
     """
-    if isinstance(data, dict):
-        return {k.lower(): standardize_keys_to_lowercase(v) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [standardize_keys_to_lowercase(elem) for elem in data]
-    else:
-        return data
+    stack = [data]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            # Records share a schema, so the renamed key layout is worked out once per schema
+            # and every other record with that layout is renamed in a single C-level update
+            keys = tuple(node)
+            lowered_keys = _LOWERCASE_SCHEMAS.get(keys)
+            if lowered_keys is None:
+                lowered_keys = tuple(k.lower() for k in keys)
+                if lowered_keys == keys:
+                    lowered_keys = () # Nothing to rename for this schema
+                if len(_LOWERCASE_SCHEMAS) < LOWERCASE_SCHEMA_CACHE_MAX_SIZE:
+                    _LOWERCASE_SCHEMAS[keys] = lowered_keys
+            # Only rebuild dicts that actually have non-lowercase keys; key order is preserved
+            if lowered_keys:
+                values = list(node.values())
+                node.clear()
+                node.update(zip(lowered_keys, values))
+            stack.extend(v for v in node.values() if isinstance(v, (dict, list)))
+        elif isinstance(node, list):
+            stack.extend(v for v in node if isinstance(v, (dict, list)))
+    return data
+
+def ingest_nba_endpoint(storage_client, bq_client, run_timestamp, label, endpoint, params, table_id, filename_prefix, record_transform=None):
+    """
+    Runs the full fetch -> GCS upload -> BigQuery load pipeline for a single NBA API endpoint.
+    Pages are fetched on a background thread and streamed into GCS as they arrive, so
+    fetching and uploading overlap. Endpoints returning fewer than DIRECT_LOAD_MAX_ROWS
+    records (or every endpoint, when ARCHIVE_TO_GCS is off) skip GCS and are loaded into
+    BigQuery directly. An optional record_transform is applied to each record as it is
+    serialized.
+    GCS files are named with the shared run_timestamp, and a schema cached from an
+    earlier run is used in place of autodetect.
+    The BigQuery load job is submitted but not awaited, so loads for all endpoints
+    run at the same time. Returns (load_job, submit_load, ndjson_file), where
+    submit_load(schema=...) resubmits the same data (e.g. with autodetect after a
+    cached-schema load fails) and ndjson_file is the local payload of a direct load
+    (None for GCS loads) for the caller to close once the load is finished, or None if
+    the pipeline failed.
+    """
+    print(f"\n--- Processing {label} Data ---")
+    pages = prefetch_pages(iter_nba_data_pages(endpoint, params))
+    ndjson_file = None
+    try:
+        records = itertools.chain.from_iterable(pages)
+        try:
+            # Buffer up to the direct-load threshold to find out how large the endpoint is
+            buffered_records = list(itertools.islice(records, DIRECT_LOAD_MAX_ROWS))
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError):
+            buffered_records = None
+        if not buffered_records:
+            print(f"No {label} data found from API or API call failed.")
+            return None
+
+        # The NDJSON payload / GCS URI is kept by submit_load so the load can be resubmitted
+        if len(buffered_records) < DIRECT_LOAD_MAX_ROWS:
+            # The whole endpoint fits under the threshold, so skip the GCS round-trip
+            ndjson_file = records_to_ndjson_file(buffered_records, record_transform)
+            submit_load = functools.partial(submit_file_load_to_bigquery, bq_client, ndjson_file, BIGQUERY_DATASET_ID, table_id)
+        elif not ARCHIVE_TO_GCS:
+            records = itertools.chain(buffered_records, records)
+            try:
+                ndjson_file = spool_records_to_ndjson_file(records, record_transform)
+            except (requests.exceptions.RequestException, orjson.JSONDecodeError):
+                # fetch_nba_api_page has already reported the error
+                print(f"Failed to stage {label} data for BigQuery.")
+                return None
+            submit_load = functools.partial(submit_file_load_to_bigquery, bq_client, ndjson_file, BIGQUERY_DATASET_ID, table_id)
+        else:
+            gcs_file_prefix = f"{filename_prefix}_{run_timestamp}"
+            records = itertools.chain(buffered_records, records)
+            gcs_uri = upload_to_gcs(storage_client, records, GCS_BUCKET_NAME, gcs_file_prefix, record_transform)
+            if not gcs_uri:
+                print(f"Failed to upload {label} data to GCS.")
+                return None
+            submit_load = functools.partial(submit_json_load_to_bigquery, bq_client, gcs_uri, BIGQUERY_DATASET_ID, table_id)
+    finally:
+        pages.close() # Stops the background fetch if we finished early
+
+    schema = get_cached_bigquery_schema(storage_client, bq_client, GCS_BUCKET_NAME, table_id)
+    load_job = submit_load(schema=schema)
+    if not load_job:
+        print(f"Failed to load {label} data into BigQuery table '{BIGQUERY_DATASET_ID}.{table_id}'.")
+        if ndjson_file is not None:
+            ndjson_file.close()
+        return None
+    return load_job, submit_load, ndjson_file
 
 if __name__ == "__main__":
+    # Per-page API messages are logged at DEBUG, so they are skipped cheaply at this level
+    logging.basicConfig(level=logging.INFO)
+
     # 1. Authenticate with Google Cloud
     gcp_credentials = authenticate_gcp()
     if not gcp_credentials:
         print("Google Cloud authentication failed. Exiting.")
         exit()
 
+    # Create the GCS and BigQuery clients once; both are thread-safe and pool their connections,
+    # so every pipeline shares them instead of re-authenticating per call
+    storage_client = storage.Client(project=PROJECT_ID, credentials=gcp_credentials)
+    bq_client = bigquery.Client(project=PROJECT_ID, credentials=gcp_credentials)
+
     # Ensure BigQuery dataset exists
-    create_bigquery_dataset_if_not_exists(gcp_credentials, BIGQUERY_DATASET_ID)
-
-    # --- Process NBA Games Data ---
-    print("\n--- Processing NBA Games Data ---")
-    games_params = {} # Using empty parameters for broader data pull
-    nba_games_data = fetch_nba_data(NBA_API_ENDPOINT_GAMES, games_params)
-    if nba_games_data:
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        gcs_games_filename = f"nba_api_games_data_{timestamp}.json"
-        gcs_games_uri = upload_to_gcs(gcp_credentials, nba_games_data, GCS_BUCKET_NAME, gcs_games_filename)
-        if gcs_games_uri:
-            success_games = load_json_to_bigquery(gcp_credentials, gcs_games_uri, BIGQUERY_DATASET_ID, BIGQUERY_TABLE_ID_GAMES)
-            if success_games:
-                print(f"NBA Games data successfully ingested into BigQuery table '{BIGQUERY_DATASET_ID}.{BIGQUERY_TABLE_ID_GAMES}'.")
-            else:
-                print(f"Failed to load NBA Games data into BigQuery table '{BIGQUERY_DATASET_ID}.{BIGQUERY_TABLE_ID_GAMES}'.")
-        else:
-            print("Failed to upload NBA Games data to GCS.")
-    else:
-        print("No NBA Games data found from API or API call failed.")
-
-    # --- Process Player Totals Data ---
-    print("\n--- Processing Player Totals Data ---")
-    playertotals_params = {} # Using empty parameters for broader data pull
-    nba_playertotals_data = fetch_nba_data(NBA_API_ENDPOINT_PLAYERTOTALS, playertotals_params)
-    if nba_playertotals_data:
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        gcs_playertotals_filename = f"nba_api_playertotals_data_{timestamp}.json"
-        gcs_playertotals_uri = upload_to_gcs(gcp_credentials, nba_playertotals_data, GCS_BUCKET_NAME, gcs_playertotals_filename)
-        if gcs_playertotals_uri:
-            success_playertotals = load_json_to_bigquery(gcp_credentials, gcs_playertotals_uri, BIGQUERY_DATASET_ID, BIGQUERY_TABLE_ID_PLAYERTOTALS)
-            if success_playertotals:
-                print(f"Player Totals data successfully ingested into BigQuery table '{BIGQUERY_DATASET_ID}.{BIGQUERY_TABLE_ID_PLAYERTOTALS}'.")
-            else:
-                print(f"Failed to load Player Totals data into BigQuery table '{BIGQUERY_DATASET_ID}.{BIGQUERY_TABLE_ID_PLAYERTOTALS}'.")
-        else:
-            print("Failed to upload Player Totals data to GCS.")
-    else:
-        print("No Player Totals data found from API or API call failed.")
-
-    # --- Process Player Advanced Stats Data ---
-    print("\n--- Processing Player Advanced Stats Data ---")
-    playeradvancedstats_params = {} # Using empty parameters for broader data pull
-    nba_playeradvancedstats_data = fetch_nba_data(NBA_API_ENDPOINT_PLAYERADVANCEDSTATS, playeradvancedstats_params)
-    if nba_playeradvancedstats_data:
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        gcs_playeradvancedstats_filename = f"nba_api_playeradvancedstats_data_{timestamp}.json"
-        gcs_playeradvancedstats_uri = upload_to_gcs(gcp_credentials, nba_playeradvancedstats_data, GCS_BUCKET_NAME, gcs_playeradvancedstats_filename)
-        if gcs_playeradvancedstats_uri:
-            success_playeradvancedstats = load_json_to_bigquery(gcp_credentials, gcs_playeradvancedstats_uri, BIGQUERY_DATASET_ID, BIGQUERY_TABLE_ID_PLAYERADVANCEDSTATS)
-            if success_playeradvancedstats:
-                print(f"Player Advanced Stats data successfully ingested into BigQuery table '{BIGQUERY_DATASET_ID}.{BIGQUERY_TABLE_ID_PLAYERADVANCEDSTATS}'.")
-            else:
-                print(f"Failed to load Player Advanced Stats data into BigQuery table '{BIGQUERY_DATASET_ID}.{BIGQUERY_TABLE_ID_PLAYERADVANCEDSTATS}'.")
-        else:
-            print("Failed to upload Player Advanced Stats data to GCS.")
-    else:
-        print("No Player Advanced Stats data found from API or API call failed.")
-
-    # --- Process Player Shot Chart Data ---
-    print("\n--- Processing Player Shot Chart Data ---")
-    playershotchart_params = {} # Using empty parameters for broader data pull
-    nba_playershotchart_data = fetch_nba_data(NBA_API_ENDPOINT_PLAYERSHOTCHART, playershotchart_params)
-
-    if nba_playershotchart_data:
-        print("Standardizing Player Shot Chart data keys to lowercase...")
-        processed_nba_playershotchart_data = standardize_keys_to_lowercase(nba_playershotchart_data)
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        gcs_playershotchart_filename = f"nba_api_playershotchart_data_{timestamp}.json"
-        # Pass the processed data to upload_to_gcs
-        gcs_playershotchart_uri = upload_to_gcs(gcp_credentials, processed_nba_playershotchart_data, GCS_BUCKET_NAME, gcs_playershotchart_filename)
-        if gcs_playershotchart_uri:
-            success_playershotchart = load_json_to_bigquery(gcp_credentials, gcs_playershotchart_uri, BIGQUERY_DATASET_ID, BIGQUERY_TABLE_ID_PLAYERSHOTCHART)
-            if success_playershotchart:
-                print(f"Player Shot Chart data successfully ingested into BigQuery table '{BIGQUERY_DATASET_ID}.{BIGQUERY_TABLE_ID_PLAYERSHOTCHART}'.")
-            else:
-                print(f"Failed to load Player Shot Chart data into BigQuery table '{BIGQUERY_DATASET_ID}.{BIGQUERY_TABLE_ID_PLAYERSHOTCHART}'.")
+    create_bigquery_dataset_if_not_exists(bq_client, BIGQUERY_DATASET_ID)
+
+    # One timestamp for the whole run, so every endpoint's files can be grouped by run
+    run_timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d_%H%M%S")
+
+    # (label, endpoint, params, BigQuery table, GCS filename prefix, record transform)
+    # Empty parameters are used for a broader data pull
+    ingestion_jobs = [
+        ("NBA Games", NBA_API_ENDPOINT_GAMES, {}, BIGQUERY_TABLE_ID_GAMES, "nba_api_games_data", None),
+        ("Player Totals", NBA_API_ENDPOINT_PLAYERTOTALS, {}, BIGQUERY_TABLE_ID_PLAYERTOTALS, "nba_api_playertotals_data", None),
+        ("Player Advanced Stats", NBA_API_ENDPOINT_PLAYERADVANCEDSTATS, {}, BIGQUERY_TABLE_ID_PLAYERADVANCEDSTATS, "nba_api_playeradvancedstats_data", None),
+        # Shot chart keys are standardized to lowercase as each record is uploaded
+        ("Player Shot Chart", NBA_API_ENDPOINT_PLAYERSHOTCHART, {}, BIGQUERY_TABLE_ID_PLAYERSHOTCHART, "nba_api_playershotchart_data", standardize_keys_to_lowercase),
+    ]
+
+    # Each pipeline is almost entirely I/O wait, so run all endpoints concurrently
+    load_jobs = []
+    with ThreadPoolExecutor(max_workers=NBA_API_MAX_CONCURRENT_ENDPOINTS) as executor:
+        futures = {
+            executor.submit(ingest_nba_endpoint, storage_client, bq_client, run_timestamp, *job): job
+            for job in ingestion_jobs
+        }
+        for future in as_completed(futures):
+            label, table_id = futures[future][0], futures[future][3]
+            try:
+                submitted_load = future.result()
+            except Exception as e:
+                print(f"Unexpected error while ingesting {label} data: {e}")
+                continue
+            if submitted_load:
+                load_jobs.append((label, table_id, *submitted_load))
+
+    # The BigQuery load jobs run server-side in parallel; only wait for them once all are submitted
+    for label, table_id, load_job, submit_load, ndjson_file in load_jobs:
+        succeeded = wait_for_bigquery_load(load_job, BIGQUERY_DATASET_ID, table_id)
+        if not succeeded and not load_job.autodetect:
+            # Don't leave the table stale for this run: reload the same data with autodetect.
+            # The cached schema is only dropped when it no longer matches the data.
+            if is_schema_mismatch(load_job):
+                clear_cached_bigquery_schema(storage_client, GCS_BUCKET_NAME, table_id)
+            print(f"Retrying {label} load into '{BIGQUERY_DATASET_ID}.{table_id}' with schema autodetection.")
+            load_job = submit_load(schema=None)
+            succeeded = load_job is not None and wait_for_bigquery_load(load_job, BIGQUERY_DATASET_ID, table_id)
+        if ndjson_file is not None:
+            ndjson_file.close() # No more retries, so release the direct-load payload (and any temp file)
+
+        if succeeded:
+            if load_job.autodetect:
+                # Remember the detected schema so later runs can skip autodetection
+                cache_bigquery_schema(storage_client, bq_client, GCS_BUCKET_NAME, BIGQUERY_DATASET_ID, table_id)
+            print(f"{label} data successfully ingested into BigQuery table '{BIGQUERY_DATASET_ID}.{table_id}'.")
         else:
-            print("Failed to upload Player Shot Chart data to GCS.")
-    else:
-        print("No Player Shot Chart data found from API or API call failed.")
+            print(f"Failed to load {label} data into BigQuery table '{BIGQUERY_DATASET_ID}.{table_id}'.")
 
     print("\n--- All NBA API data ingestion attempts complete ---")
\ No newline at end of file